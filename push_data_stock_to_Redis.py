@@ -1,7 +1,15 @@
-import psycopg2
-import psycopg2.extras
-import redis
-import json
+from psycopg.rows import tuple_row
+from psycopg_pool import AsyncConnectionPool
+import redis.asyncio as redis
+from redis.utils import HIREDIS_AVAILABLE
+import asyncio
+import calendar
+from bisect import bisect_right
+from datetime import date
+from itertools import islice
+import orjson
+import lz4.frame
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import os
 import logging
@@ -10,218 +18,342 @@ from fastapi import FastAPI, HTTPException
 # --- CẤU HÌNH LOGGING ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_db_connection():
-    load_dotenv()
-    conn = psycopg2.connect(
-        user=os.getenv("user"),
-        password=os.getenv("password"),
-        host=os.getenv("host"),
-        port=os.getenv("port"),
-        dbname=os.getenv("dbname")
+# --- CẤU HÌNH KẾT NỐI (đọc file .env một lần khi import module) ---
+load_dotenv()
+
+PG_KW = {
+    "user": os.getenv("user"),
+    "password": os.getenv("password"),
+    "host": os.getenv("host"),
+    "port": os.getenv("port"),
+    "dbname": os.getenv("dbname"),
+}
+
+REDIS_KW = {
+    "host": os.getenv("REDIS_HOST"),
+    "port": os.getenv("REDIS_PORT"),
+    "password": os.getenv("REDIS_PASSWORD"),
+}
+
+# Bật nén LZ4 cho dữ liệu trên Redis (REDIS_COMPRESSION=lz4). Khi bật, dữ liệu được ghi vào
+# các key có hậu tố ":lz4" để client phân biệt và giải nén bằng lz4.frame.decompress.
+# Key watermark luôn là văn bản thường, không có hậu tố (xem build_watermark_key).
+REDIS_COMPRESSION = (os.getenv("REDIS_COMPRESSION") or "").lower()
+
+# Số kết nối Redis tối đa mỗi worker được mở
+REDIS_MAX_CONNECTIONS = 16
+
+# --- CONNECTION POOL (khởi tạo một lần khi ứng dụng khởi động) ---
+PG_POOL: AsyncConnectionPool | None = None
+REDIS_POOL: redis.ConnectionPool | None = None
+# Tránh hai lời gọi đồng thời cùng tạo pool khi khởi tạo muộn (ngoài lifespan)
+POOL_INIT_LOCK = asyncio.Lock()
+
+async def init_connection_pools():
+    """
+    Tạo các connection pool còn thiếu cho Postgres và Redis; pool đã mở thì giữ nguyên.
+    """
+    async with POOL_INIT_LOCK:
+        if PG_POOL is None:
+            await init_pg_pool()
+        if REDIS_POOL is None:
+            init_redis_pool()
+    logging.info("Đã khởi tạo connection pool cho PostgreSQL và Redis.")
+
+async def init_pg_pool():
+    global PG_POOL
+    # Pool đủ lớn để mỗi cổ phiếu dùng một kết nối riêng khi xử lý song song
+    pg_pool = AsyncConnectionPool(
+        min_size=4,
+        max_size=8,
+        # Mỗi dòng là một tuple thay vì dict; chỉ đọc dữ liệu nên không cần bọc mỗi lệnh trong BEGIN/COMMIT.
+        # prepare_threshold=None: không tạo prepared statement phía server, vì pooler chế độ
+        # transaction (ví dụ Supabase) có thể chuyển lệnh sang kết nối không có statement đó.
+        kwargs={**PG_KW, "row_factory": tuple_row, "autocommit": True, "prepare_threshold": None},
+        open=False
     )
-    return conn
+    await pg_pool.open()
+    PG_POOL = pg_pool
 
-def get_redis_connection():
-    load_dotenv()
-    r = redis.Redis(
-        host=os.getenv("REDIS_HOST"),
-        port=os.getenv("REDIS_PORT"),
-        password=os.getenv("REDIS_PASSWORD"),
-        decode_responses=True
+def init_redis_pool():
+    global REDIS_POOL
+    # BlockingConnectionPool: khi hết kết nối thì chờ thay vì báo lỗi "Too many connections"
+    REDIS_POOL = redis.BlockingConnectionPool(
+        **REDIS_KW,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        # Chỉ ghi dữ liệu bytes từ orjson, không cần decode/encode qua str
+        decode_responses=False
     )
-    return r
+    if not HIREDIS_AVAILABLE:
+        # redis-py tự dùng parser C của hiredis khi được cài, nếu không sẽ dùng parser Python chậm hơn
+        logging.warning("Không tìm thấy hiredis, Redis sẽ dùng parser thuần Python.")
+
+async def close_connection_pools():
+    global PG_POOL, REDIS_POOL
+    if PG_POOL:
+        await PG_POOL.close()
+        PG_POOL = None
+    if REDIS_POOL:
+        await REDIS_POOL.disconnect()
+        REDIS_POOL = None
+    logging.info("Đã đóng các connection pool.")
+
+def get_redis_connection():
+    return redis.Redis(connection_pool=REDIS_POOL)
+
+STOCKS_TO_PROCESS = ["FPT", "GAS", "IMP", "VCB"]
+
+# --- CẤU HÌNH CÁC KHOẢNG THỜI GIAN ---
+# Số tháng lùi lại của mỗi khoảng thời gian; "all" lấy toàn bộ lịch sử
+RANGE_MONTHS = {
+    "1M": 1,
+    "3M": 3,
+    "1Y": 12,
+    "5Y": 60,
+}
+RANGE_KEYS = ["all", *RANGE_MONTHS]
+
+# Các khoảng thời gian kèm predict_price quá khứ và predict_price 10 ngày tới
+PREDICTION_RANGES = ["1M", "3M"]
+
+# Mỗi phần là một nhánh của truy vấn UNION ALL: (cột giá, điều kiện lọc thêm).
+# Các khoảng thời gian được cắt ra từ kết quả bằng bisect, nên chỉ cần lấy:
+# toàn bộ close_price, predict_price quá khứ của khoảng dự đoán dài nhất và predict_price 10 ngày tới.
+HISTORY_PART, PAST_PREDICTION_PART, FUTURE_PREDICTION_PART = range(3)
+
+QUERY_PARTS = [
+    ("close_price", ""),
+    ("predict_price", f"\"date\" >= (NOW() - INTERVAL '{max(RANGE_MONTHS[k] for k in PREDICTION_RANGES)} months') AND \"date\" < NOW()::date"),
+    ("predict_price", "\"date\" >= NOW()::date AND \"date\" <= (NOW()::date + INTERVAL '10 days')"),
+]
+
+# Kiểu dữ liệu các cột ("part", "date", "price") của truy vấn, dùng để giải mã COPY dạng binary
+QUERY_COLUMN_TYPES = ["int4", "text", "float8"]
+
+# Số ngày gần nhất được băm vào watermark để phát hiện giá được cập nhật tại chỗ
+WATERMARK_RECENT_DAYS = 15
+
+# Thời gian hết hạn của dữ liệu trên Redis (1 ngày)
+REDIS_TTL_SECONDS = 86400
+
+# ARGV[1] là TTL, ARGV[i + 1] là giá trị của KEYS[i]
+SET_WITH_EXPIRE_SCRIPT = """
+for i = 1, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[i + 1], 'EX', ARGV[1])
+end
+return #KEYS
+"""
 
 # --- HÀM LOGIC ---
 
-def process_rows(rows, price_column_name='close_price'):
-    """
-    Hàm phụ trợ để xử lý các dòng dữ liệu, chuyển đổi và làm sạch (cho các trường hợp thông thường).
+def build_redis_key(stock_ticker: str, range_key: str) -> str:
+    key = f"stock:{stock_ticker}:{range_key}"
+    if REDIS_COMPRESSION == "lz4":
+        key += ":lz4"
+    return key
+
+def build_watermark_key(stock_ticker: str) -> str:
+    return f"stock:{stock_ticker}:watermark"
+
+def encode_payload(stock_data) -> bytes:
+    payload = orjson.dumps(stock_data)
+    if REDIS_COMPRESSION == "lz4":
+        payload = lz4.frame.compress(payload)
+    return payload
+
+def build_ticker_query(stock_ticker: str) -> str:
     """
-    processed_rows = []
-    for row in rows:
-        if row.get('date') is None or row.get(price_column_name) is None:
-            logging.warning(f"Bỏ qua dòng dữ liệu bị thiếu: date hoặc {price_column_name} là NULL. Dữ liệu: {row}")
-            continue
-        
-        try:
-            processed_rows.append({
-                'date': row['date'].strftime('%Y-%m-%d'),
-                'close_price': float(str(row[price_column_name]).replace(',', ''))
-            })
-        except (ValueError, TypeError) as e:
-            logging.error(f"Không thể chuyển đổi giá trị {price_column_name} thành số: '{row[price_column_name]}'. Lỗi: {e}. Bỏ qua dòng này.")
-            continue
-    return processed_rows
-
-def process_rows_with_prediction(rows, price_column_name='close_price', keep_original_label=False):
+    Tạo một truy vấn UNION ALL duy nhất trả về dữ liệu cần cho tất cả các khoảng thời gian của một cổ phiếu.
+    Mỗi dòng được gắn nhãn `part` (chỉ số trong QUERY_PARTS) để Python phân nhóm lại.
+    Việc lọc NULL, định dạng ngày và ép kiểu giá được thực hiện ngay trong Postgres.
     """
-    Hàm xử lý dữ liệu với khả năng giữ nguyên label gốc cho predict_price.
+    table_name = f'"{stock_ticker}_Stock"'
+    branches = []
+    for part, (price_column, condition) in enumerate(QUERY_PARTS):
+        where_clause = f'"date" IS NOT NULL AND "{price_column}" IS NOT NULL'
+        if condition:
+            where_clause += f" AND {condition}"
+        branches.append(f"""
+        SELECT {part} AS "part", to_char("date", 'YYYY-MM-DD') AS "date", "{price_column}"::float8 AS "price"
+        FROM {table_name}
+        WHERE {where_clause}""")
+    return "\n        UNION ALL".join(branches) + '\n        ORDER BY "part" ASC, "date" ASC'
+
+def shift_months(day: date, months: int) -> date:
     """
-    processed_rows = []
-    for row in rows:
-        if row.get('date') is None or row.get(price_column_name) is None:
-            logging.warning(f"Bỏ qua dòng dữ liệu bị thiếu: date hoặc {price_column_name} là NULL. Dữ liệu: {row}")
-            continue
-        
-        try:
-            processed_row = {
-                'date': row['date'].strftime('%Y-%m-%d'),
-            }
-            
-            if keep_original_label and price_column_name == 'predict_price':
-                processed_row['predict_price'] = float(str(row[price_column_name]).replace(',', ''))
-            else:
-                processed_row['close_price'] = float(str(row[price_column_name]).replace(',', ''))
-                
-            processed_rows.append(processed_row)
-        except (ValueError, TypeError) as e:
-            logging.error(f"Không thể chuyển đổi giá trị {price_column_name} thành số: '{row[price_column_name]}'. Lỗi: {e}. Bỏ qua dòng này.")
-            continue
-    return processed_rows
-
-def fetch_stock_data(cursor, stock_ticker: str, time_condition: str):
+    Cộng/trừ số tháng cho một ngày, giữ ngày cuối tháng như Postgres (31/03 - 1 tháng = 28/02 hoặc 29/02).
     """
-    Hàm phụ trợ để lấy và xử lý dữ liệu cho một cổ phiếu với một điều kiện thời gian cụ thể.
-    Áp dụng cho các trường hợp: all, 1Y, 5Y.
+    month_index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+def build_range_buckets(history, past_predictions, future_predictions, today: date):
     """
-    table_name = f'"{stock_ticker}_Stock"'
-    logging.info(f"Bắt đầu lấy dữ liệu cho bảng: {table_name} với điều kiện: {time_condition or 'Tất cả'}...")
-    
-    query = f"""
-        SELECT "date", "close_price" 
-        FROM {table_name} 
-        {time_condition}
-        ORDER BY "date" ASC;
+    Cắt dữ liệu của từng khoảng thời gian từ các danh sách đã sắp xếp theo ngày tăng dần.
+    Vì mỗi khoảng là một đoạn cuối của lịch sử, vị trí bắt đầu được tìm bằng bisect
+    thay vì truy vấn lại Postgres. Các mốc ngày dạng 'YYYY-MM-DD' nên so sánh chuỗi là đủ.
     """
-    
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    logging.info(f"Đã lấy được {len(rows)} dòng.")
-    
-    return process_rows(rows, 'close_price')
-
-def fetch_stock_data_combined(cursor, stock_ticker: str, interval_str: str):
+    history_dates = [row['date'] for row in history]
+    past_prediction_dates = [row['date'] for row in past_predictions]
+    today_str = today.isoformat()
+
+    buckets = {"all": history}
+    for range_key, months in RANGE_MONTHS.items():
+        # Tương đương điều kiện "date" >= NOW() - INTERVAL: NOW() luôn sau nửa đêm nên ngày mốc bị loại
+        cutoff = shift_months(today, -months).isoformat()
+        start = bisect_right(history_dates, cutoff)
+        if range_key in PREDICTION_RANGES:
+            end = bisect_right(history_dates, today_str)
+            prediction_start = bisect_right(past_prediction_dates, cutoff)
+            # Ghi thẳng vào một danh sách thay vì nối nhiều danh sách tạm bằng "+"
+            combined = history[start:end]
+            combined.extend(islice(past_predictions, prediction_start, None))
+            combined.extend(future_predictions)
+            buckets[range_key] = combined
+        else:
+            buckets[range_key] = history[start:]
+    return buckets
+
+async def fetch_watermarks():
     """
-    Hàm MỚI: Lấy dữ liệu lịch sử và dữ liệu dự đoán trong một khoảng thời gian (interval) nhất định,
-    cùng với dữ liệu dự đoán 10 ngày tới.
+    Lấy watermark của tất cả cổ phiếu trong một truy vấn. Watermark gồm ngày close_price mới nhất,
+    ngày lớn nhất (kể cả dự đoán), số giá trị close_price/predict_price và mã băm md5 của
+    WATERMARK_RECENT_DAYS ngày gần nhất, để phát hiện cả khi close_price hôm nay được điền vào dòng
+    dự đoán có sẵn hay predict_price được sửa tại chỗ. Ngày hiện tại được ghép thêm vì các khoảng
+    1M/3M/1Y/5Y trượt theo NOW(), cùng chế độ nén để đổi REDIS_COMPRESSION sẽ buộc đồng bộ lại toàn bộ.
+    Trả về (dict {ticker: watermark}, ngày hiện tại của Postgres); watermark là None nếu bảng chưa có dữ liệu.
     """
-    table_name = f'"{stock_ticker}_Stock"'
-    range_label = interval_str.replace("'", "").replace(" ", "_") # e.g., '1_month'
-    logging.info(f"Bắt đầu lấy dữ liệu KẾT HỢP ({range_label}) cho bảng: {table_name}...")
+    branches = []
+    for ticker in STOCKS_TO_PROCESS:
+        branches.append(f"""
+        SELECT '{ticker}', MAX("date") IS NOT NULL, format('%s|%s|%s|%s|%s',
+            MAX("date") FILTER (WHERE "close_price" IS NOT NULL),
+            MAX("date"),
+            COUNT("close_price"),
+            COUNT("predict_price"),
+            md5(string_agg(format('%s:%s:%s', "date", "close_price", "predict_price"), ',' ORDER BY "date")
+                FILTER (WHERE "date" >= CURRENT_DATE - {WATERMARK_RECENT_DAYS}))
+        ), CURRENT_DATE
+        FROM "{ticker}_Stock\"""")
+    query = "\n        UNION ALL".join(branches) + ";"
 
-    # 1. Lấy dữ liệu quá khứ (close_price) trong khoảng thời gian đã cho
-    past_historical_query = f"""
-        SELECT "date", "close_price"
-        FROM {table_name}
-        WHERE "date" >= (NOW() - INTERVAL {interval_str}) AND "date" <= NOW()::date
-        ORDER BY "date" ASC;
-    """
-    cursor.execute(past_historical_query)
-    past_historical_rows = cursor.fetchall()
-    logging.info(f"{range_label} - Quá khứ (close_price): Đã lấy được {len(past_historical_rows)} dòng.")
-    processed_past_historical = process_rows(past_historical_rows, 'close_price')
-    
-    # 2. Lấy dữ liệu predict_price của quá khứ (nếu có)
-    past_prediction_query = f"""
-        SELECT "date", "predict_price"
-        FROM {table_name}
-        WHERE "date" >= (NOW() - INTERVAL {interval_str}) AND "date" < NOW()::date
-        AND "predict_price" IS NOT NULL
-        ORDER BY "date" ASC;
+    async with PG_POOL.connection() as pg_conn:
+        cursor = await pg_conn.execute(query)
+        rows = await cursor.fetchall()
+
+    today = rows[0][3]
+    watermarks = {
+        ticker: f"{fingerprint}@{today.isoformat()}@{REDIS_COMPRESSION or 'json'}" if has_data else None
+        for ticker, has_data, fingerprint, _ in rows
+    }
+    return watermarks, today
+
+async def fetch_stock_data_all_ranges(stock_ticker: str, today: date):
     """
-    cursor.execute(past_prediction_query)
-    past_prediction_rows = cursor.fetchall()
-    logging.info(f"{range_label} - Quá khứ (predict_price): Đã lấy được {len(past_prediction_rows)} dòng.")
-    processed_past_predictions = process_rows_with_prediction(past_prediction_rows, 'predict_price', keep_original_label=True)
-
-    # 3. Lấy dữ liệu dự đoán (predict_price) từ hôm nay đến 10 ngày sau
-    future_query = f"""
-        SELECT "date", "predict_price"
-        FROM {table_name}
-        WHERE "date" >= NOW()::date AND "date" <= (NOW()::date + INTERVAL '10 days')
-        ORDER BY "date" ASC;
+    Lấy và xử lý dữ liệu của tất cả các khoảng thời gian (all, 1M, 3M, 1Y, 5Y) cho một cổ phiếu
+    chỉ bằng một lần gọi tới Postgres, trên một kết nối riêng lấy từ pool.
+    Trả về dict {range_key: danh sách bản ghi}.
+    Dữ liệu được đọc dần qua COPY ... TO STDOUT (FORMAT BINARY) thay vì fetchall().
     """
-    cursor.execute(future_query)
-    future_rows = cursor.fetchall()
-    logging.info(f"{range_label} - Dự đoán: Đã lấy được {len(future_rows)} dòng.")
-    processed_future_data = process_rows_with_prediction(future_rows, 'predict_price', keep_original_label=True)
-    
-    # 4. Kết hợp tất cả dữ liệu
-    all_past_data = processed_past_historical + processed_past_predictions
-    combined_data = all_past_data + processed_future_data
-    logging.info(f"{range_label} - Tổng cộng: {len(combined_data)} dòng sau khi kết hợp.")
-    
-    return combined_data
-
-def sync_stock_data_to_redis():
+    logging.info(f"Bắt đầu lấy dữ liệu cho bảng: \"{stock_ticker}_Stock\" (tất cả các khoảng thời gian)...")
+
+    rows_by_part = [[] for _ in QUERY_PARTS]
+    row_count = 0
+    # COPY truyền dữ liệu thành luồng liên tục thay vì từng message DataRow; psycopg giải mã binary trong C
+    copy_query = f"COPY ({build_ticker_query(stock_ticker)}) TO STDOUT (FORMAT BINARY)"
+    async with PG_POOL.connection() as pg_conn, pg_conn.cursor() as cursor:
+        async with cursor.copy(copy_query) as copy:
+            copy.set_types(QUERY_COLUMN_TYPES)
+            async for part, date_str, price in copy.rows():
+                row_count += 1
+                price_column, _ = QUERY_PARTS[part]
+                rows_by_part[part].append({'date': date_str, price_column: price})
+
+    logging.info(f"{stock_ticker} - Đã lấy được {row_count} dòng.")
+    return build_range_buckets(
+        rows_by_part[HISTORY_PART],
+        rows_by_part[PAST_PREDICTION_PART],
+        rows_by_part[FUTURE_PREDICTION_PART],
+        today
+    )
+
+async def sync_stock_data_to_redis():
     """
     Hàm chính để đồng bộ dữ liệu giá cổ phiếu từ Postgres sang Redis.
     """
     logging.info("Bắt đầu quá trình đồng bộ dữ liệu CỔ PHIẾU...")
-    pg_conn = None
-    
-    STOCKS_TO_PROCESS = ["FPT", "GAS", "IMP", "VCB"]
-    
-    # --- CẬP NHẬT: Đánh dấu 3M là trường hợp đặc biệt ---
-    TIME_RANGES = {
-        "all": "",
-        "1M": "SPECIAL_CASE",
-        "3M": "SPECIAL_CASE",
-        "1Y": "WHERE \"date\" >= NOW() - INTERVAL '1 year'",
-        "5Y": "WHERE \"date\" >= NOW() - INTERVAL '5 years'",
-    }
-
-    # --- CẬP NHẬT: Tạo một map để định nghĩa interval cho các trường hợp đặc biệt ---
-    SPECIAL_CASE_INTERVALS = {
-        "1M": "'1 month'",
-        "3M": "'3 months'"
-    }
+    if PG_POOL is None or REDIS_POOL is None:
+        await init_connection_pools()
 
     try:
-        pg_conn = get_db_connection()
-        cursor = pg_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         redis_conn = get_redis_connection()
 
-        with redis_conn.pipeline() as pipe:
-            for ticker in STOCKS_TO_PROCESS:
-                for range_key, condition in TIME_RANGES.items():
-                    stock_data = []
-                    
-                    # --- CẬP NHẬT: Logic để xử lý các trường hợp đặc biệt một cách linh hoạt ---
-                    if condition == "SPECIAL_CASE":
-                        # Lấy interval tương ứng từ map
-                        interval = SPECIAL_CASE_INTERVALS.get(range_key)
-                        if interval:
-                            # Gọi hàm kết hợp mới với interval tương ứng
-                            stock_data = fetch_stock_data_combined(cursor, ticker, interval)
-                        else:
-                            logging.warning(f"Không tìm thấy định nghĩa interval cho trường hợp đặc biệt: {range_key}")
-                    else:
-                        # Giữ nguyên logic cũ cho các trường hợp khác (all, 1Y, 5Y)
-                        stock_data = fetch_stock_data(cursor, ticker, condition)
-                    
-                    if stock_data:
-                        redis_key = f"stock:{ticker}:{range_key}"
-                        json_data = json.dumps(stock_data)
-                        pipe.set(redis_key, json_data, ex=86400) # Hết hạn sau 1 ngày
-                        logging.info(f"Đã chuẩn bị đẩy {len(stock_data)} bản ghi cho key '{redis_key}'.")
-
-            pipe.execute()
-        
+        # So sánh watermark trong Postgres với watermark của lần đồng bộ trước trên Redis
+        watermarks, today = await fetch_watermarks()
+        synced_watermarks = await redis_conn.mget([build_watermark_key(ticker) for ticker in STOCKS_TO_PROCESS])
+
+        changed_tickers = []
+        unchanged_tickers = []
+        for ticker, synced_watermark in zip(STOCKS_TO_PROCESS, synced_watermarks):
+            watermark = watermarks.get(ticker)
+            if watermark is not None and synced_watermark is not None and synced_watermark.decode() == watermark:
+                unchanged_tickers.append(ticker)
+            else:
+                changed_tickers.append(ticker)
+
+        if unchanged_tickers:
+            # Dữ liệu không đổi: chỉ gia hạn TTL, bỏ qua truy vấn nặng
+            logging.info(f"Dữ liệu không thay đổi, chỉ gia hạn TTL cho: {', '.join(unchanged_tickers)}")
+            async with redis_conn.pipeline(transaction=False) as pipe:
+                for ticker in unchanged_tickers:
+                    for range_key in RANGE_KEYS:
+                        pipe.expire(build_redis_key(ticker, range_key), REDIS_TTL_SECONDS)
+                    pipe.expire(build_watermark_key(ticker), REDIS_TTL_SECONDS)
+                expire_results = await pipe.execute()
+
+            # Key "all" không còn (bị evict/xoá) dù watermark vẫn khớp: coi như dữ liệu đã thay đổi
+            keys_per_ticker = len(RANGE_KEYS) + 1
+            all_key_index = RANGE_KEYS.index("all")
+            for i, ticker in enumerate(unchanged_tickers):
+                if not expire_results[i * keys_per_ticker + all_key_index]:
+                    logging.warning(f"Không tìm thấy key '{build_redis_key(ticker, 'all')}', đồng bộ lại {ticker}.")
+                    changed_tickers.append(ticker)
+
+        # Một truy vấn cho mỗi cổ phiếu, các cổ phiếu được truy vấn song song
+        all_buckets = await asyncio.gather(*[fetch_stock_data_all_ranges(ticker, today) for ticker in changed_tickers])
+
+        redis_payloads = {}
+        for ticker, buckets in zip(changed_tickers, all_buckets):
+            for range_key, stock_data in buckets.items():
+                if stock_data:
+                    redis_key = build_redis_key(ticker, range_key)
+                    redis_payloads[redis_key] = encode_payload(stock_data)
+                    logging.info(f"Đã chuẩn bị đẩy {len(stock_data)} bản ghi cho key '{redis_key}'.")
+            if watermarks.get(ticker) is not None:
+                redis_payloads[build_watermark_key(ticker)] = watermarks[ticker]
+
+        if redis_payloads:
+            # Ghi tất cả các key trong một lần gọi script, Redis thực thi nguyên tử
+            set_with_expire = redis_conn.register_script(SET_WITH_EXPIRE_SCRIPT)
+            await set_with_expire(keys=list(redis_payloads), args=[REDIS_TTL_SECONDS, *redis_payloads.values()])
+
         logging.info("Đã đẩy thành công tất cả dữ liệu cổ phiếu lên Redis.")
         return {"status": "success", "message": "Stock data synced successfully."}
 
     except Exception as e:
         logging.error(f"Đã xảy ra lỗi trong quá trình đồng bộ dữ liệu cổ phiếu: {e}")
         raise e
-    finally:
-        if pg_conn:
-            pg_conn.close()
-            logging.info("Đã đóng kết nối PostgreSQL.")
 
 
 # --- TẠO ỨNG DỤNG VÀ API ENDPOINT ---
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_connection_pools()
+    yield
+    await close_connection_pools()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/")
 async def health_check():
@@ -230,7 +362,7 @@ async def health_check():
 @app.post("/push_stock_data")
 async def trigger_stock_sync_endpoint():
     try:
-        result = sync_stock_data_to_redis()
+        result = await sync_stock_data_to_redis()
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -0,0 +1,256 @@
+-- Chuyển các bảng "{ticker}_Stock" sang PARTITION BY RANGE ("date"), mỗi năm một partition,
+-- kèm covering index ("date") INCLUDE ("close_price", "predict_price") và partial index cho
+-- predict_price.
+--
+-- Ảnh hưởng tới các truy vấn mà push_data_stock_to_Redis.py thực sự chạy:
+--   - nhánh lịch sử (toàn bộ close_price, không có điều kiện theo "date") và truy vấn watermark
+--     (MAX/COUNT trên cả bảng) vẫn đọc mọi partition;
+--   - chỉ hai nhánh predict_price (3 tháng trước và 10 ngày tới) được loại bỏ partition, chạm
+--     tới 1-2 partition (NOW() được tính khi thực thi nên Postgres vẫn loại bỏ được) và có thể
+--     dùng partial index;
+--   - kết quả được ORDER BY theo chuỗi to_char("date"), nên luôn có bước sort, không tận dụng
+--     thứ tự của index.
+-- Index-only scan chỉ xảy ra khi visibility map đã được cập nhật: chạy VACUUM ANALYZE ở cuối
+-- script (nằm ngoài BEGIN/COMMIT vì VACUUM không chạy được trong transaction).
+--
+-- Được giữ lại trên bảng mới:
+--   - DEFAULT, CHECK, NOT NULL và cột IDENTITY (sequence identity được setval theo dữ liệu cũ);
+--   - PRIMARY KEY / UNIQUE có chứa cột "date" (giữ nguyên tên, nên ON CONFLICT vẫn dùng được).
+--     Nếu bảng có PRIMARY KEY / UNIQUE không chứa "date", script dừng lại vì Postgres không cho
+--     phép ràng buộc đó trên bảng partition;
+--   - script cũng dừng lại nếu có view / materialized view đọc bảng: view gắn với OID của bảng
+--     nên sẽ đi theo bảng cũ sau khi đổi tên và không còn thấy dữ liệu mới. Cần xoá các view đó
+--     trước và tạo lại sau khi chạy script;
+--   - quyền đã GRANT trên bảng, trạng thái ROW LEVEL SECURITY và các policy RLS;
+--   - sequence của cột serial được chuyển sang thuộc bảng mới (OWNED BY), để xoá bảng cũ
+--     không làm hỏng INSERT.
+-- KHÔNG được chuyển sang, cần tạo lại thủ công nếu có: các index khác ngoài ràng buộc (script in
+-- NOTICE cho từng index), trigger, foreign key, publication (Supabase Realtime) và comment.
+--
+-- Bảng cũ được giữ lại dưới tên "{ticker}_Stock_old" để kiểm tra trước khi xoá; các ràng buộc
+-- PRIMARY KEY / UNIQUE của nó được đổi tên với hậu tố "_old".
+-- Partition theo năm được tạo bằng hàm create_stock_year_partition(ticker, year). Hàm này
+-- chuyển các dòng của năm đó đang nằm trong partition "{ticker}_Stock_default" sang partition
+-- mới, nên có thể chạy lại bất cứ lúc nào. Nếu có extension pg_cron, script đăng ký job
+-- "create-stock-year-partitions" chạy ngày 1 hằng tháng để tạo sẵn partition của năm sau;
+-- nếu không, cần chạy tay (ít nhất mỗi năm một lần, trước ngày 20/12):
+--   SELECT create_stock_year_partition(t, EXTRACT(YEAR FROM CURRENT_DATE)::int + 1)
+--   FROM unnest(ARRAY['FPT', 'GAS', 'IMP', 'VCB']) AS t;
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION create_stock_year_partition(stock_ticker text, partition_year int)
+RETURNS void
+LANGUAGE plpgsql
+AS $fn$
+DECLARE
+    tbl text := stock_ticker || '_Stock';
+    partition_name text := stock_ticker || '_Stock_' || partition_year;
+    default_name text := stock_ticker || '_Stock_default';
+    range_start date := make_date(partition_year, 1, 1);
+    range_end date := make_date(partition_year + 1, 1, 1);
+BEGIN
+    IF to_regclass(format('%I', partition_name)) IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    IF to_regclass(format('%I', default_name)) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+            partition_name, tbl, range_start, range_end
+        );
+        RETURN;
+    END IF;
+
+    -- Postgres không cho tạo partition khi partition default còn dòng thuộc khoảng mới:
+    -- tạm chuyển các dòng đó ra, tạo partition rồi ghi lại qua bảng cha
+    EXECUTE format(
+        'CREATE TEMP TABLE stock_partition_rows AS SELECT * FROM %I WHERE "date" >= %L AND "date" < %L',
+        default_name, range_start, range_end
+    );
+    EXECUTE format('DELETE FROM %I WHERE "date" >= %L AND "date" < %L', default_name, range_start, range_end);
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name, tbl, range_start, range_end
+    );
+    -- OVERRIDING SYSTEM VALUE: giữ nguyên giá trị của các cột GENERATED ALWAYS AS IDENTITY
+    EXECUTE format('INSERT INTO %I OVERRIDING SYSTEM VALUE SELECT * FROM stock_partition_rows', tbl);
+    DROP TABLE stock_partition_rows;
+END
+$fn$;
+
+DO $$
+DECLARE
+    ticker text;
+    tbl text;
+    old_tbl text;
+    old_oid oid;
+    first_year int;
+    last_year int;
+    y int;
+    rec record;
+BEGIN
+    FOREACH ticker IN ARRAY ARRAY['FPT', 'GAS', 'IMP', 'VCB'] LOOP
+        tbl := ticker || '_Stock';
+        old_tbl := tbl || '_old';
+
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', tbl, old_tbl);
+        old_oid := format('%I', old_tbl)::regclass;
+
+        -- View / materialized view gắn với OID của bảng nên sẽ tiếp tục đọc bảng cũ sau khi đổi tên
+        FOR rec IN
+            SELECT DISTINCT r.ev_class::regclass AS view_name
+            FROM pg_depend d
+            JOIN pg_rewrite r ON r.oid = d.objid
+            WHERE d.classid = 'pg_rewrite'::regclass
+              AND d.refclassid = 'pg_class'::regclass
+              AND d.refobjid = old_oid
+              AND r.ev_class <> old_oid
+        LOOP
+            RAISE EXCEPTION 'View % đang đọc bảng %, cần xoá và tạo lại view này quanh việc chạy script', rec.view_name, tbl;
+        END LOOP;
+
+        -- PRIMARY KEY / UNIQUE trên bảng partition bắt buộc phải chứa khoá partition
+        FOR rec IN
+            SELECT c.conname
+            FROM pg_constraint c
+            WHERE c.conrelid = old_oid AND c.contype IN ('p', 'u')
+              AND NOT EXISTS (
+                  SELECT 1 FROM pg_attribute a
+                  WHERE a.attrelid = old_oid AND a.attname = 'date' AND a.attnum = ANY (c.conkey)
+              )
+        LOOP
+            RAISE EXCEPTION 'Ràng buộc % của bảng % không chứa cột "date", không thể giữ trên bảng partition', rec.conname, tbl;
+        END LOOP;
+
+        EXECUTE format(
+            'CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY) PARTITION BY RANGE ("date")',
+            tbl, old_tbl
+        );
+
+        EXECUTE format(
+            'SELECT COALESCE(EXTRACT(YEAR FROM MIN("date"))::int, EXTRACT(YEAR FROM CURRENT_DATE)::int) FROM %I',
+            old_tbl
+        ) INTO first_year;
+        -- Dữ liệu dự đoán 10 ngày tới có thể vượt sang năm sau
+        last_year := EXTRACT(YEAR FROM CURRENT_DATE)::int + 1;
+
+        FOR y IN first_year..last_year LOOP
+            PERFORM create_stock_year_partition(ticker, y);
+        END LOOP;
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', tbl || '_default', tbl);
+
+        -- OVERRIDING SYSTEM VALUE: giữ nguyên giá trị của các cột GENERATED ALWAYS AS IDENTITY
+        EXECUTE format('INSERT INTO %I OVERRIDING SYSTEM VALUE SELECT * FROM %I', tbl, old_tbl);
+
+        -- Sequence identity của bảng mới tiếp tục từ giá trị lớn nhất đã có
+        FOR rec IN
+            SELECT a.attname
+            FROM pg_attribute a
+            WHERE a.attrelid = format('%I', tbl)::regclass AND a.attidentity <> '' AND NOT a.attisdropped
+        LOOP
+            EXECUTE format(
+                'SELECT setval(pg_get_serial_sequence(%L, %L), max(%I)) FROM %I',
+                format('%I', tbl), rec.attname, rec.attname, tbl
+            );
+        END LOOP;
+
+        -- Sequence của cột serial (DEFAULT nextval(...)) chuyển sang thuộc bảng mới
+        FOR rec IN
+            SELECT a.attname, pg_get_serial_sequence(format('%I', old_tbl), a.attname) AS seq
+            FROM pg_attribute a
+            WHERE a.attrelid = old_oid AND a.attnum > 0 AND NOT a.attisdropped AND a.attidentity = ''
+        LOOP
+            IF rec.seq IS NOT NULL THEN
+                EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I', rec.seq, tbl, rec.attname);
+            END IF;
+        END LOOP;
+
+        -- Tạo lại PRIMARY KEY / UNIQUE với tên cũ; ràng buộc của bảng cũ được đổi tên để tránh trùng index
+        FOR rec IN
+            SELECT c.conname, pg_get_constraintdef(c.oid) AS definition
+            FROM pg_constraint c
+            WHERE c.conrelid = old_oid AND c.contype IN ('p', 'u')
+        LOOP
+            EXECUTE format('ALTER TABLE %I RENAME CONSTRAINT %I TO %I', old_tbl, rec.conname, rec.conname || '_old');
+            EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I %s', tbl, rec.conname, rec.definition);
+        END LOOP;
+
+        FOR rec IN
+            SELECT i.indexrelid::regclass AS index_name
+            FROM pg_index i
+            WHERE i.indrelid = old_oid
+              AND NOT EXISTS (
+                  SELECT 1 FROM pg_constraint c WHERE c.conrelid = old_oid AND c.conindid = i.indexrelid
+              )
+        LOOP
+            RAISE NOTICE 'Index % của bảng cũ không được tạo lại trên %', rec.index_name, tbl;
+        END LOOP;
+
+        -- Quyền đã GRANT trên bảng cũ
+        FOR rec IN
+            SELECT acl.privilege_type,
+                   CASE WHEN acl.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(acl.grantee)) END AS grantee
+            FROM pg_class c, aclexplode(c.relacl) acl
+            WHERE c.oid = old_oid
+        LOOP
+            EXECUTE format('GRANT %s ON %I TO %s', rec.privilege_type, tbl, rec.grantee);
+        END LOOP;
+
+        -- Row Level Security và các policy (Supabase)
+        IF (SELECT relrowsecurity FROM pg_class WHERE oid = old_oid) THEN
+            EXECUTE format('ALTER TABLE %I ENABLE ROW LEVEL SECURITY', tbl);
+        END IF;
+        IF (SELECT relforcerowsecurity FROM pg_class WHERE oid = old_oid) THEN
+            EXECUTE format('ALTER TABLE %I FORCE ROW LEVEL SECURITY', tbl);
+        END IF;
+        FOR rec IN
+            SELECT p.policyname, p.permissive, p.cmd, p.qual, p.with_check,
+                   array_to_string(ARRAY(SELECT quote_ident(r) FROM unnest(p.roles) AS r), ', ') AS roles
+            FROM pg_policies p
+            WHERE p.schemaname = current_schema() AND p.tablename = old_tbl
+        LOOP
+            EXECUTE format(
+                'CREATE POLICY %I ON %I AS %s FOR %s TO %s%s%s',
+                rec.policyname, tbl, rec.permissive, rec.cmd, rec.roles,
+                CASE WHEN rec.qual IS NOT NULL THEN ' USING (' || rec.qual || ')' ELSE '' END,
+                CASE WHEN rec.with_check IS NOT NULL THEN ' WITH CHECK (' || rec.with_check || ')' ELSE '' END
+            );
+        END LOOP;
+
+        -- Covering index: truy vấn theo khoảng "date" có thể là index-only scan (sau VACUUM)
+        EXECUTE format(
+            'CREATE INDEX %I ON %I ("date") INCLUDE ("close_price", "predict_price")',
+            tbl || '_date_covering_idx', tbl
+        );
+        -- Partial index cho các nhánh chỉ đọc predict_price
+        EXECUTE format(
+            'CREATE INDEX %I ON %I ("date") INCLUDE ("predict_price") WHERE "predict_price" IS NOT NULL',
+            tbl || '_date_predict_idx', tbl
+        );
+    END LOOP;
+END
+$$;
+
+-- Tạo sẵn partition của năm sau mỗi tháng một lần (hàm bỏ qua nếu partition đã có)
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_cron') THEN
+        PERFORM cron.schedule(
+            'create-stock-year-partitions',
+            '0 0 1 * *',
+            $cron$SELECT create_stock_year_partition(t, EXTRACT(YEAR FROM CURRENT_DATE)::int + 1) FROM unnest(ARRAY['FPT', 'GAS', 'IMP', 'VCB']) AS t$cron$
+        );
+    ELSE
+        RAISE NOTICE 'Không có pg_cron: cần chạy create_stock_year_partition cho năm sau trước ngày 20/12 hằng năm';
+    END IF;
+END
+$$;
+
+COMMIT;
+
+-- Cập nhật visibility map và thống kê để planner dùng được index-only scan
+VACUUM (ANALYZE) "FPT_Stock";
+VACUUM (ANALYZE) "GAS_Stock";
+VACUUM (ANALYZE) "IMP_Stock";
+VACUUM (ANALYZE) "VCB_Stock";